@@ -9,12 +9,35 @@ from datetime import datetime, timedelta
 from io import BytesIO
 
 from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import Response, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from docx import Document
+from docx.oxml.ns import qn
 
 app = FastAPI(title="Validador de Transcripciones")
 
+# ==========================
+# Límite de tamaño de subida
+# ==========================
+MAX_BYTES = 20 * 1024 * 1024  # 20 MB por archivo
+MAX_REQUEST_BYTES = MAX_BYTES + 1024 * 1024  # margen para cabeceras multipart
+
+# Se registra antes que CORS para que CORS quede por fuera y el 413 lleve sus cabeceras
+@app.middleware("http")
+async def limitar_content_length(request, call_next):
+    """Rechazar con 413 antes de recibir el cuerpo si Content-Length excede el límite"""
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_REQUEST_BYTES:
+        return JSONResponse({"detail": "Archivo demasiado grande"}, status_code=413)
+    return await call_next(request)
+
+async def leer_limitado(file: UploadFile) -> bytes:
+    """Leer la subida, abortando con 413 si supera MAX_BYTES"""
+    if file.size is not None and file.size > MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Archivo demasiado grande")
+    return await file.read()
+
 # ==========================
 # CORS: habilitar solo tus dominios
 # ==========================
@@ -53,8 +76,31 @@ def cleanup_downloads():
 # Validaciones
 # ==========================
 ETIQUETAS_VALIDAS = ["ENTREVISTADOR:", "ENTREVISTADORA:", "ENTREVISTADO:", "ENTREVISTADA:"]
+ETIQUETAS_VALIDAS_SET = frozenset(ETIQUETAS_VALIDAS)
+ETIQUETAS_NEGRITA = frozenset(["ENTREVISTADOR:", "ENTREVISTADORA:"])
+MAYUSCULAS_ETIQUETA = "ABCDEFGHIJKLMNOPQRSTUVWXYZÁÉÍÓÚÑ"
+
+# Tipos de error
+TIPO_ETIQUETA_INVALIDA = "Etiqueta inválida"
+TIPO_FORMATO_INCORRECTO = "Formato incorrecto"
+TIPO_ENCABEZADO_SIN_NEGRITA = "Encabezado sin negrita"
+TIPO_FORMATO_NEGRITA = "Formato en negrita"
+TIPO_FUENTE_INCORRECTA = "Fuente incorrecta"
+TIPO_TAMANO_INCORRECTO = "Tamaño incorrecto"
 REGEX_PERMITIDOS = r"[^A-Za-zÁÉÍÓÚáéíóúÑñ0-9\s\.,:\?¿]"
 
+# Patrones precompilados (se usan en cada párrafo/run)
+PERMITIDOS_RE = re.compile(REGEX_PERMITIDOS)
+TIMESTAMP_RE = re.compile(r"\d{1,2}:\d{2}")
+
+# Atributos de formato leídos directamente del XML de cada run (w:rPr)
+W_RFONTS = qn("w:rFonts")
+W_ASCII = qn("w:ascii")
+W_SZ = qn("w:sz")
+W_VAL = qn("w:val")
+FUENTE_OK = "Arial"
+TAMANO_OK_MEDIOS_PUNTOS = "24"  # w:sz se expresa en medios puntos (12pt)
+
 def char_human(ch: str) -> str:
     code = f"U+{ord(ch):04X}"
     name = unicodedata.name(ch, "UNKNOWN")
@@ -62,7 +108,7 @@ def char_human(ch: str) -> str:
     return f"{visible} ({code} {name})"
 
 def validar_y_limpiar(doc: Document, filename: str):
-    errores = []
+    errores = []  # tuplas (linea, tipo, descripcion); nunca se convierten a dict
     especiales_count = 0
     char_counter = Counter()
 
@@ -71,111 +117,132 @@ def validar_y_limpiar(doc: Document, filename: str):
         if not texto:
             continue
 
-        texto_norm = texto.lower()
-
         # Ignorar timestamps tipo mm:ss
-        if re.fullmatch(r"\d{1,2}:\d{2}", texto):
+        if TIMESTAMP_RE.fullmatch(texto):
             continue
 
+        # python-docx crea objetos Run nuevos en cada acceso a para.runs;
+        # se materializan una sola vez por párrafo.
+        runs = para.runs
+
+        texto_norm = texto.lower()
+
         # Validaciones etiquetas
         if "speaker" in texto_norm:
-            errores.append((i+1, "Etiqueta inválida", f"Se encontró '{texto}'. Usa 'ENTREVISTADOR:' o 'ENTREVISTADO:'."))
+            errores.append((i+1, TIPO_ETIQUETA_INVALIDA, f"Se encontró '{texto}'. Usa 'ENTREVISTADOR:' o 'ENTREVISTADO:'."))
 
         if "usuario" in texto_norm:
-            errores.append((i+1, "Etiqueta inválida", f"Se encontró 'Usuario'. Usa 'ENTREVISTADO:' o 'ENTREVISTADOR:'."))
+            errores.append((i+1, TIPO_ETIQUETA_INVALIDA, f"Se encontró 'Usuario'. Usa 'ENTREVISTADO:' o 'ENTREVISTADOR:'."))
 
         if "xxx" in texto_norm:
-            errores.append((i+1, "Etiqueta inválida", f"Se encontró '{texto}'. Reemplázalo por la etiqueta correcta."))
-
-        match = re.match(r"^([A-ZÁÉÍÓÚÑ]+:)", texto)
-        if match:
-            etiqueta = match.group(1)
-            if etiqueta not in ETIQUETAS_VALIDAS:
-                errores.append((i+1, "Etiqueta inválida", f"Se encontró '{etiqueta}'. Usa solo {ETIQUETAS_VALIDAS}"))
+            errores.append((i+1, TIPO_ETIQUETA_INVALIDA, f"Se encontró '{texto}'. Reemplázalo por la etiqueta correcta."))
+
+        # Clasificar el prefijo "ETIQUETA:" una sola vez por párrafo; el mismo
+        # resultado alimenta las reglas de etiqueta, etiqueta sola y negrita.
+        cabeza, sep, resto = texto.partition(":")
+        if sep and cabeza and not cabeza.strip(MAYUSCULAS_ETIQUETA):
+            etiqueta = cabeza + sep
+            if etiqueta not in ETIQUETAS_VALIDAS_SET:
+                errores.append((i+1, TIPO_ETIQUETA_INVALIDA, f"Se encontró '{etiqueta}'. Usa solo {ETIQUETAS_VALIDAS}"))
             else:
-                if texto == etiqueta:
-                    errores.append((i+1, "Formato incorrecto", f"La etiqueta '{etiqueta}' está sola. Debe ir junto con el texto."))
+                if not resto:
+                    errores.append((i+1, TIPO_FORMATO_INCORRECTO, f"La etiqueta '{etiqueta}' está sola. Debe ir junto con el texto."))
 
-                if etiqueta in ["ENTREVISTADOR:", "ENTREVISTADORA:"]:
-                    encabezado_ok = any(run.text.strip().startswith(etiqueta) and run.bold for run in para.runs)
+                if etiqueta in ETIQUETAS_NEGRITA:
+                    encabezado_ok = any(run.text.strip().startswith(etiqueta) and run.bold for run in runs)
                     if not encabezado_ok:
-                        errores.append((i+1, "Encabezado sin negrita", f"La etiqueta '{etiqueta}' debería estar en negrita."))
+                        errores.append((i+1, TIPO_ENCABEZADO_SIN_NEGRITA, f"La etiqueta '{etiqueta}' debería estar en negrita."))
 
-                    all_bold = all(run.bold or not run.text.strip() for run in para.runs)
+                    all_bold = all(run.bold or not run.text.strip() for run in runs)
                     if not all_bold:
-                        errores.append((i+1, "Formato en negrita", f"El texto de '{etiqueta}' debería estar completamente en negrita."))
+                        errores.append((i+1, TIPO_FORMATO_NEGRITA, f"El texto de '{etiqueta}' debería estar completamente en negrita."))
 
         # Fuente/tamaño
-        for run in para.runs:
-            fuente = run.font.name
-            tamano = run.font.size.pt if run.font.size else None
-            if fuente and fuente.lower() != "arial":
-                errores.append((i+1, "Fuente incorrecta", f"Se detectó la fuente '{fuente}' en vez de Arial."))
-                break
-            if tamano and tamano != 12:
-                errores.append((i+1, "Tamaño incorrecto", f"Se detectó {tamano}pt en vez de 12pt."))
+        for run in runs:
+            rPr = run.element.rPr
+            if rPr is None:
+                continue
+            rFonts = rPr.find(W_RFONTS)
+            fuente = rFonts.get(W_ASCII) if rFonts is not None else None
+            if fuente and fuente != FUENTE_OK and fuente.lower() != "arial":
+                errores.append((i+1, TIPO_FUENTE_INCORRECTA, f"Se detectó la fuente '{fuente}' en vez de Arial."))
                 break
+            sz = rPr.find(W_SZ)
+            medios_puntos = sz.get(W_VAL) if sz is not None else None
+            if medios_puntos and medios_puntos != TAMANO_OK_MEDIOS_PUNTOS:
+                tamano = run.font.size.pt if run.font.size else None
+                if tamano and tamano != 12:
+                    errores.append((i+1, TIPO_TAMANO_INCORRECTO, f"Se detectó {tamano}pt en vez de 12pt."))
+                    break
 
         # Limpieza
-        for run in para.runs:
-            if run.text:
-                encontrados = re.findall(REGEX_PERMITIDOS, run.text)
+        for run in runs:
+            texto_run = run.text
+            if texto_run:
+                encontrados = PERMITIDOS_RE.findall(texto_run)
                 if encontrados:
                     especiales_count += len(encontrados)
                     char_counter.update(encontrados)
-                    run.text = re.sub(REGEX_PERMITIDOS, "", run.text)
+                    run.text = PERMITIDOS_RE.sub("", texto_run)
 
     # Guardar en memoria
     docx_bytes = BytesIO()
     doc.save(docx_bytes)
     docx_bytes.seek(0)
 
-    # Crear reporte
-    txt_bytes = BytesIO()
-    resumen = {}
-
-    txt_bytes.write(f"📋 REPORTE DE ERRORES\nArchivo: {filename}\nGenerado: {datetime.now()}\n\n".encode("utf-8"))
+    # Crear reporte (líneas acumuladas y unidas/codificadas una sola vez)
+    resumen = Counter(tipo for _, tipo, _ in errores)
+    lineas = ["📋 REPORTE DE ERRORES", f"Archivo: {filename}", f"Generado: {datetime.now()}", ""]
     for linea, tipo, desc in errores:
-        txt_bytes.write(f"Línea {linea}: {tipo} → {desc}\n".encode("utf-8"))
-        resumen[tipo] = resumen.get(tipo, 0) + 1
+        lineas.append(f"Línea {linea}: {tipo} → {desc}")
 
     if resumen:
-        txt_bytes.write("\n--- RESUMEN DE ERRORES ---\n".encode("utf-8"))
+        lineas.append("")
+        lineas.append("--- RESUMEN DE ERRORES ---")
         for tipo, count in resumen.items():
-            txt_bytes.write(f"{tipo}: {count} ocurrencias\n".encode("utf-8"))
+            lineas.append(f"{tipo}: {count} ocurrencias")
 
-    txt_bytes.write("\n--- LIMPIEZA DE TEXTO ---\n".encode("utf-8"))
-    txt_bytes.write(f"Total de caracteres especiales eliminados: {especiales_count}\n".encode("utf-8"))
-    txt_bytes.write(f"Tipos únicos eliminados: {len(char_counter)}\n".encode("utf-8"))
+    lineas.append("")
+    lineas.append("--- LIMPIEZA DE TEXTO ---")
+    lineas.append(f"Total de caracteres especiales eliminados: {especiales_count}")
+    lineas.append(f"Tipos únicos eliminados: {len(char_counter)}")
     if char_counter:
-        txt_bytes.write("\nDetalle por carácter:\n".encode("utf-8"))
+        lineas.append("")
+        lineas.append("Detalle por carácter:")
         for ch, cnt in char_counter.most_common():
-            txt_bytes.write(f"  {char_human(ch)} → {cnt}\n".encode("utf-8"))
+            lineas.append(f"  {char_human(ch)} → {cnt}")
 
-    txt_bytes.seek(0)
+    txt_bytes = ("\n".join(lineas) + "\n").encode("utf-8")
 
     return docx_bytes, txt_bytes
 
 
 @app.post("/procesar/")
 async def procesar(file: UploadFile = File(...)):
+    data = await leer_limitado(file)
+
+    # El parseo y la validación son síncronos: se ejecutan en el threadpool
+    # para no bloquear el event loop mientras se atienden otras peticiones.
     try:
-        doc = Document(file.file)
+        doc = await run_in_threadpool(Document, BytesIO(data))
     except Exception as e:
-        return {"error": f"No se pudo abrir el archivo: {e}"}
+        return JSONResponse({"error": f"No se pudo abrir el archivo: {e}"})
 
-    docx_bytes, txt_bytes = validar_y_limpiar(doc, file.filename)
+    docx_bytes, txt_bytes = await run_in_threadpool(validar_y_limpiar, doc, file.filename)
 
-    # Crear ZIP en memoria
+    # Crear ZIP en memoria: el DOCX ya viene comprimido, se guarda sin
+    # recomprimir; el reporte de texto usa deflate rápido (nivel 1).
+    base, ext = os.path.splitext(file.filename)
     zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w") as zipf:
-        zipf.writestr(file.filename.replace(".docx", "_limpio.docx"), docx_bytes.read())
-        zipf.writestr(file.filename.replace(".docx", "_errores.txt"), txt_bytes.read())
-    zip_buffer.seek(0)
+    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_STORED) as zipf:
+        zipf.writestr(f"{base}_limpio{ext}", docx_bytes.getbuffer())
+        zipf.writestr(f"{base}_errores.txt", txt_bytes,
+                      compress_type=zipfile.ZIP_DEFLATED, compresslevel=1)
+    zip_data = zip_buffer.getvalue()
 
     # Crear token único
     token = str(uuid.uuid4())
-    DOWNLOADS[token] = (zip_buffer.getvalue(), datetime.utcnow() + timedelta(minutes=EXP_MINUTES))
+    DOWNLOADS[token] = (zip_data, datetime.utcnow() + timedelta(minutes=EXP_MINUTES))
 
     return JSONResponse({"token": token, "expires_in": EXP_MINUTES})
 
@@ -191,4 +258,6 @@ def download_token(token: str):
         DOWNLOADS.pop(token, None)
         raise HTTPException(status_code=410, detail="Link expirado")
     headers = {"Content-Disposition": "attachment; filename=reportes_transcripciones.zip"}
-    return StreamingResponse(io.BytesIO(data), media_type="application/zip", headers=headers)
+    # El ZIP ya está completo en memoria: se envía tal cual, sin envolverlo
+    # en un BytesIO para iterarlo por bloques.
+    return Response(content=data, media_type="application/zip", headers=headers)